@@ -2,9 +2,33 @@
 import pandas as pd
 import numpy
 import pathlib
+import io
+import os
+import json
+import tempfile
+import contextlib
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+from concurrent.futures import ThreadPoolExecutor
+## isal's igzip is a drop in, much faster replacement for the standard gzip module ##
+## fall back to the standard library if it isnt installed ##
+try:
+    from isal import igzip as gzip
+except ImportError:
+    import gzip
 
 class DataLoader():
     ## this class retrieves, loads, and merges data ##
+    ## download policy -- a (connect, read) timeout in seconds so a stalled connection ##
+    ## fails and can be retried, and retries w/ backoff when nflverse is rate ##
+    ## limiting or has a transient server error ##
+    download_timeout = (10, 60)
+    download_retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504]
+    )
     def __init__(self):
         ## dfs we want to output ##
         self.model_df = None
@@ -29,27 +53,135 @@ class DataLoader():
             'completions', 'attempts', 'passing_yards', 'passing_tds',
             'interceptions', 'sacks', 'carries', 'rushing_yards', 'rushing_tds'
         ]
+        ## weight of each stat col in the VALUE formula, in the same order ##
+        self.value_weights = numpy.array([
+            3.7, -2.2, 1 / 5, 11.3,
+            -14.1, -8, -1.1, 0.6, 15.9
+        ])
         ## load file path ##
         data_folder = pathlib.Path(__file__).parent.parent.resolve()
         self.missing_draft_data = '{0}/Manual Data/missing_draft_data.csv'.format(data_folder)
+        ## downloaded nflverse files are cached here and only re-downloaded when they change ##
+        self.cache_folder = '{0}/.cache'.format(data_folder)
         ## get data on load ##
         self.pull_data()
-        
-    def retrieve_player_stats(self):
+    
+    def create_session(self):
+        ## requests does not guarantee a session is thread safe, and downloads run on ##
+        ## separate worker threads, so each download gets its own session ##
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(max_retries=self.download_retry))
+        return session
+    
+    def fetch_file(self, url):
+        ## download a file to the local cache and return its location ##
+        ## if the file is already cached, the server is asked whether it has changed ##
+        ## and the cached copy is used when it has not ##
+        os.makedirs(self.cache_folder, exist_ok=True)
+        file_loc = '{0}/{1}'.format(self.cache_folder, url.split('/')[-1])
+        headers_loc = '{0}.headers.json'.format(file_loc)
+        request_headers = {}
+        if os.path.exists(file_loc) and os.path.exists(headers_loc):
+            with open(headers_loc) as fp:
+                cached_headers = json.load(fp)
+            if cached_headers.get('etag') is not None:
+                request_headers['If-None-Match'] = cached_headers['etag']
+            if cached_headers.get('last_modified') is not None:
+                request_headers['If-Modified-Since'] = cached_headers['last_modified']
+        with self.create_session() as session, session.get(
+            url,
+            headers=request_headers,
+            stream=True,
+            timeout=self.download_timeout
+        ) as resp:
+            if resp.status_code == 304:
+                return file_loc
+            resp.raise_for_status()
+            ## write to a uniquely named temp file and move it into place so an ##
+            ## interrupted or concurrent download never leaves a partial file in the cache ##
+            ## the temp file is removed if anything fails before it is moved ##
+            fp = tempfile.NamedTemporaryFile(dir=self.cache_folder, delete=False)
+            try:
+                with fp:
+                    for chunk in resp.iter_content(chunk_size=128 * 1024):
+                        fp.write(chunk)
+                ## drop the old headers first, so they can never be paired w/ the new file ##
+                ## another run may have already removed them ##
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(headers_loc)
+                os.replace(fp.name, file_loc)
+            except BaseException:
+                os.remove(fp.name)
+                raise
+            headers_fp = tempfile.NamedTemporaryFile(
+                'w', dir=self.cache_folder, delete=False
+            )
+            try:
+                with headers_fp:
+                    json.dump({
+                        'etag' : resp.headers.get('ETag'),
+                        'last_modified' : resp.headers.get('Last-Modified'),
+                    }, headers_fp)
+                os.replace(headers_fp.name, headers_loc)
+            except BaseException:
+                os.remove(headers_fp.name)
+                raise
+        return file_loc
+    
+    ## download only funcs, which are run concurrently by pull_data ##
+    def load_player_stats(self):
         ## download stats from nflverse ##
         ## these are pre-aggregated from the pbp, which saves time/compute ##
-        try:
-            df = pd.read_csv(
-                self.player_stats_url,
-                compression='gzip',
-                low_memory=False
+        ## decompress the file ourselves rather than letting pandas use the ##
+        ## slower standard gzip module ##
+        with io.BufferedReader(
+            gzip.open(self.fetch_file(self.player_stats_url), 'rb'),
+            buffer_size=128 * 1024
+        ) as fp:
+            ## only qbs are relevant, so filter each chunk as it is read rather than ##
+            ## holding every position in memory, and only parse the fields we use ##
+            reader = pd.read_csv(
+                fp,
+                compression=None,
+                usecols=[
+                    'player_id', 'player_name', 'player_display_name',
+                    'position', 'recent_team', 'season', 'week'
+                ] + self.stat_cols,
+                chunksize=100000
             )
-            ## only  qbs are relevant ##
-            df=df[
-                df['position'] == 'QB'
-            ].copy()
+            return pd.concat([
+                chunk[chunk['position'] == 'QB'] for chunk in reader
+            ], ignore_index=True)
+    
+    def load_player_meta(self):
+        ## download player meta from nflverse ##
+        ## only parse the fields that are joined to the stats ##
+        return pd.read_csv(
+            self.fetch_file(self.player_info_url),
+            usecols=[
+                'gsis_id', 'first_name', 'last_name',
+                'birth_date', 'rookie_year', 'entry_year',
+                'draft_number'
+            ]
+        )
+    
+    def load_game_data(self):
+        ## download game data from nflverse ##
+        return pd.read_csv(
+            self.fetch_file(self.game_data_url)
+        )
+    
+    def standardize_teams(self, teams, repl):
+        ## swap old team abbreviations for the ones used in the model ##
+        ## mapping is a single hash lookup, which is much faster than replace ##
+        ## abbreviations not in the repl dict are left as is ##
+        return teams.map(repl).fillna(teams)
+    
+    def retrieve_player_stats(self, df):
+        ## format the downloaded player stats ##
+        try:
             ## file only has recent abbreviation of team name. Standardize so we can join ##
-            df['recent_team'] = df['recent_team'].replace(self.player_file_repl)
+            df['recent_team'] = self.standardize_teams(df['recent_team'], self.player_file_repl)
             df = df.rename(columns={
                 'recent_team': 'team',
             })
@@ -58,7 +190,7 @@ class DataLoader():
             print('     Error retrieving player stats: ' + str(e))
             return None
     
-    def retrieve_player_meta(self, df):
+    def retrieve_player_meta(self, df, meta):
         ## get player meta and add it to the stats ##
         ## will be used for draft position and joining ##
         ## the meta file has missing draft data, which has been manually compiled ##
@@ -69,8 +201,8 @@ class DataLoader():
                 self.missing_draft_data,
                 index_col=0
             )
-            ## groupby id to ensure no dupes ##
-            missing_draft = missing_draft.groupby(['player_id']).head(1)
+            ## dedupe on id ##
+            missing_draft = missing_draft.drop_duplicates(subset=['player_id'], keep='first')
             ## rename the cols, which will fill if main in NA ##
             missing_draft = missing_draft.rename(columns={
                 'rookie_year' : 'rookie_year_fill',
@@ -79,42 +211,44 @@ class DataLoader():
                 'birth_date' : 'birth_date_fill',
             })
             ## add to data ##
-            df = pd.merge(
-                df,
+            df = df.join(
                 missing_draft[[
                     'player_id', 'rookie_year_fill', 'draft_number_fill',
                     'entry_year_fill', 'birth_date_fill'
-                ]],
-                on=['player_id'],
+                ]].set_index('player_id'),
+                on='player_id',
                 how='left'
             )
             ## fill in missing data ##
-            for col in [
-                'rookie_year', 'draft_number', 'entry_year', 'birth_date'
-            ]:
-                ## fill in missing data ##
-                df[col] = df[col].combine_first(df[col + '_fill'])
-                ## and then drop fill col ##
-                df = df.drop(columns=[col + '_fill'])
+            fill_cols = ['rookie_year', 'draft_number', 'entry_year', 'birth_date']
+            df[fill_cols] = df[fill_cols].fillna(
+                df[[col + '_fill' for col in fill_cols]].rename(
+                    columns=lambda col: col[:-len('_fill')]
+                )
+            )
+            ## and then drop fill cols ##
+            df = df.drop(columns=[col + '_fill' for col in fill_cols])
+            ## fillna keeps an int field as int when every row already had a value, so ##
+            ## cast the numeric fields to float, as they are whenever any value is missing ##
+            df = df.astype({
+                'rookie_year' : 'float64',
+                'draft_number' : 'float64',
+                'entry_year' : 'float64',
+            })
             ## return ##
             return df
         ## get player meta ##
         try:
-            meta = pd.read_csv(
-                self.player_info_url
-            )
-            meta = meta.groupby(['gsis_id']).head(1)
+            ## many players in the meta file have no gsis id, and can't be joined ##
+            meta = meta.dropna(subset=['gsis_id']).drop_duplicates(subset=['gsis_id'], keep='first')
             ## add to df ##
-            df = pd.merge(
-                df,
+            df = df.join(
                 meta[[
                     'gsis_id', 'first_name', 'last_name',
                     'birth_date', 'rookie_year', 'entry_year',
                     'draft_number'
-                ]].rename(columns={
-                    'gsis_id': 'player_id',
-                }),
-                on=['player_id'],
+                ]].set_index('gsis_id'),
+                on='player_id',
                 how='left'
             )
             ## add missing draft data ##
@@ -125,60 +259,47 @@ class DataLoader():
             print('     Error retrieving player info: ' + str(e))
             return None
     
-    def add_game_data(self, df):
+    def add_game_data(self, df, game):
         ## add game data ##
         try:
-            game = pd.read_csv(
-                self.game_data_url
-            )
             ## replace team names ##
-            game['home_team'] = game['home_team'].replace(self.games_file_repl)
-            game['away_team'] = game['away_team'].replace(self.games_file_repl)
+            game['home_team'] = self.standardize_teams(game['home_team'], self.games_file_repl)
+            game['away_team'] = self.standardize_teams(game['away_team'], self.games_file_repl)
             ## use replaced home and away names to reconstitute the game id ##
-            game['game_id'] = (
-                game['season'].astype(str) + '_' +
-                game['week'].astype(str).str.zfill(2) + '_' +
-                game['away_team'] + '_' +
-                game['home_team']
-            )
+            game['game_id'] = game['season'].astype(str).str.cat([
+                game['week'].astype(str).str.zfill(2),
+                game['away_team'],
+                game['home_team'],
+            ], sep='_')
             ## games will be used in the future so add to class ##
-            self.games = game.copy()
-            ## flatten ##
-            game_flat = pd.concat([
-                game[[
-                    'game_id', 'gameday', 'season', 'week',
-                    'home_team', 'away_team',
-                    'home_qb_id', 'home_qb_name',
-                    'away_qb_id', 'away_qb_name',
-                ]].rename(columns={
-                    'home_team' : 'team',
-                    'home_qb_id' : 'starter_id',
-                    'home_qb_name' : 'starter_name',
-                    'away_team' : 'opponent',
-                    'away_qb_id' : 'opponent_starter_id',
-                    'away_qb_name' : 'opponent_starter_name',
-                }),
-                game[[
-                    'game_id', 'gameday', 'season', 'week',
-                    'home_team', 'away_team',
-                    'home_qb_id', 'home_qb_name',
-                    'away_qb_id', 'away_qb_name',
-                ]].rename(columns={
-                    'away_team' : 'team',
-                    'away_qb_id' : 'starter_id',
-                    'away_qb_name' : 'starter_name',
-                    'home_team' : 'opponent',
-                    'home_qb_id' : 'opponent_starter_id',
-                    'home_qb_name' : 'opponent_starter_name',
-                })
-            ])
+            self.games = game
+            ## flatten into one row per team per game ##
+            ## home rows are stacked on top of away rows, so each field is its home ##
+            ## and away arrays concatenated, w/ the sides swapped for the opponent ##
+            def stack(first_field, second_field):
+                return numpy.concatenate([
+                    game[first_field].to_numpy(),
+                    game[second_field].to_numpy()
+                ])
+            game_flat = pd.DataFrame({
+                'game_id' : stack('game_id', 'game_id'),
+                'gameday' : stack('gameday', 'gameday'),
+                'season' : stack('season', 'season'),
+                'week' : stack('week', 'week'),
+                'team' : stack('home_team', 'away_team'),
+                'opponent' : stack('away_team', 'home_team'),
+                'starter_id' : stack('home_qb_id', 'away_qb_id'),
+                'starter_name' : stack('home_qb_name', 'away_qb_name'),
+                'opponent_starter_id' : stack('away_qb_id', 'home_qb_id'),
+                'opponent_starter_name' : stack('away_qb_name', 'home_qb_name'),
+            }, copy=False)
             ## add to df ##
-            df = pd.merge(
-                df,
-                game_flat,
-                on=['season','week','team'],
+            ## a team can match more than one game, so reset the index to keep it unique ##
+            df = df.join(
+                game_flat.set_index(['season', 'week', 'team']),
+                on=['season', 'week', 'team'],
                 how='left'
-            )
+            ).reset_index(drop=True)
             ## return ##
             return df
         except Exception as e:
@@ -186,23 +307,6 @@ class DataLoader():
             return None
     
     ## funcs for calculating value and formatting model file ##
-    def aggregate_team_stats(self, df, team_field='team'):
-        ## aggregates the individual player file into a team file ##
-        ## team field denotes whether to use team or opponent ##
-        return df.groupby(['game_id', 'season', 'week', 'gameday', team_field]).agg(
-            completions = ('completions', 'sum'),
-            attempts = ('attempts', 'sum'),
-            passing_yards = ('passing_yards', 'sum'),
-            passing_tds = ('passing_tds', 'sum'),
-            interceptions = ('interceptions', 'sum'),
-            sacks = ('sacks', 'sum'),
-            carries = ('carries', 'sum'),
-            rushing_yards = ('rushing_yards', 'sum'),
-            rushing_tds = ('rushing_tds', 'sum'),
-        ).reset_index().rename(columns={
-            team_field : 'team'
-        })
-    
     def iso_top_passer(self, df):
         ## So as not to update the rating of a QB who had few passes, only include
         ## the top passer ##
@@ -214,23 +318,36 @@ class DataLoader():
             1,
             numpy.nan
         )
-        return df.sort_values(
-            by=['game_id', 'is_starter', 'attempts'],
-            ascending=[True, False, False]
-        ).groupby(['game_id', 'team']).head(1).reset_index(drop=True)
+        ## rather than sorting the whole df, take the passer w/ the most attempts in each ##
+        ## game, and then override it w/ the starter wherever there is one ##
+        ## missing attempts rank below every real value, as they did in the sort ##
+        ## keep the group sort so games stay in order, which start_number relies on ##
+        attempts = df['attempts'].fillna(-numpy.inf)
+        top_idx = attempts.groupby(
+            [df['game_id'], df['team']],
+            observed=True
+        ).idxmax()
+        is_starter = df['is_starter'] == 1
+        starter_idx = attempts[is_starter].groupby(
+            [df.loc[is_starter, 'game_id'], df.loc[is_starter, 'team']],
+            observed=True
+        ).idxmax()
+        top_idx.update(starter_idx)
+        return df.loc[top_idx].reset_index(drop=True)
     
     def format_top_passer(self, df):
         ## add the start number to the top passer and get rid of unecessary fields ##
         ## note, since we arent pre-loading the existing CSV with data before 1999, this number ##
         ## is an approximation ##
         ## since we will eventually throw out data pre-2022, this is fine (probably) ##
-        df['start_number'] = df.groupby(['player_id']).cumcount() + 1
-        return df[[
+        ## cumcount only needs the order of rows within each player, so skip sorting the groups ##
+        df['start_number'] = df.groupby('player_id', sort=False, observed=True).cumcount() + 1
+        return df.loc[:, [
             'game_id', 'season', 'week', 'gameday', 'team', 'opponent', 'player_id', 'player_name', 'player_display_name',
             'start_number', 'rookie_year', 'entry_year', 'draft_number',
             'completions', 'attempts', 'passing_yards', 'passing_tds',
             'interceptions', 'sacks', 'carries', 'rushing_yards', 'rushing_tds'
-        ]].copy()
+        ]]
     
     def calculate_raw_value(self, df):
         ## takes a df, with properly named fields and returns a series w/ VALUE ##
@@ -245,44 +362,64 @@ class DataLoader():
         ##       1.1 * Rush Attempts +
         ##       0.6 * Rushing Yards +
         ##        15.9 * Rushing TDs
-        return (
-            -2.2 * df['attempts'] +
-            3.7 * df['completions'] +
-            (df['passing_yards'] / 5) +
-            11.3 * df['passing_tds'] -
-            14.1 * df['interceptions'] -
-            8 * df['sacks'] -
-            1.1 * df['carries'] +
-            0.6 * df['rushing_yards'] +
-            15.9 * df['rushing_tds']
+        ## since the formula is linear, it is a single matrix-vector product ##
+        return pd.Series(
+            df[self.stat_cols].to_numpy(dtype=numpy.float64) @ self.value_weights,
+            index=df.index
         )
     
+    def calculate_team_value(self, df):
+        ## takes the player df and returns a series w/ each team's VALUE, indexed by ##
+        ## game_id and team ##
+        ## since the formula is linear, a team's VALUE is the sum of its players' VALUE, ##
+        ## which skips aggregating every stat col before applying the formula ##
+        ## missing stats count as 0, just as they do when the stats are summed ##
+        player_value = self.calculate_raw_value(df[self.stat_cols].fillna(0))
+        return player_value.groupby(
+            [df['game_id'], df['team']],
+            sort=False,
+            observed=True
+        ).sum().rename('team_VALUE')
+    
     def pull_data(self):
         ## wrapper for all the above functions ##
         print('Retrieving nflverse data...')
-        df = self.retrieve_player_stats()
-        while df is not None:
-            ## data retrieval ##
-            df = self.retrieve_player_meta(df)
-            df = self.add_game_data(df)
-            ## merge and format ##
-            ## team stats ##
-            df_team = self.aggregate_team_stats(df)
-            df_team['team_VALUE'] = self.calculate_raw_value(df_team)
-            df_team = df_team.drop(columns=self.stat_cols)
-            ## df ##
-            df = self.iso_top_passer(df)
-            df = self.format_top_passer(df)
-            df['player_VALUE'] = self.calculate_raw_value(df)
-            df = df.drop(columns=self.stat_cols)
-            ## create model file ##
-            df = pd.merge(
-                df,
-                df_team[['game_id', 'team', 'team_VALUE']],
-                on=['game_id', 'team'],
-                how='left'
-            )
-            self.model_df = df.copy()
-            print('     Successfully retrived and stored')
-            ## end loop ##
-            df = None
+        ## the downloads are independent, so fetch them concurrently ##
+        try:
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                stats_future = executor.submit(self.load_player_stats)
+                meta_future = executor.submit(self.load_player_meta)
+                game_future = executor.submit(self.load_game_data)
+                stats = stats_future.result()
+                meta = meta_future.result()
+                game = game_future.result()
+        except Exception as e:
+            print('     Error downloading nflverse data: ' + str(e))
+            return
+        ## data retrieval ##
+        ## each step prints its own error and returns None if it fails ##
+        df = self.retrieve_player_stats(stats)
+        if df is None:
+            return
+        df = self.retrieve_player_meta(df, meta)
+        if df is None:
+            return
+        df = self.add_game_data(df, game)
+        if df is None:
+            return
+        ## merge and format ##
+        ## team stats ##
+        team_value = self.calculate_team_value(df)
+        ## df ##
+        df = self.iso_top_passer(df)
+        df = self.format_top_passer(df)
+        df['player_VALUE'] = self.calculate_raw_value(df)
+        df = df.drop(columns=self.stat_cols)
+        ## create model file ##
+        df = df.join(
+            team_value,
+            on=['game_id', 'team'],
+            how='left'
+        )
+        self.model_df = df
+        print('     Successfully retrived and stored')